@@ -0,0 +1,62 @@
+"""Conversão das legendas JSON3 do YouTube em texto.
+
+Importar este módulo não tem efeitos colaterais: é o único código que os
+processos do pool de legendas carregam.
+"""
+import logging
+import ijson
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker(log_level: int) -> None:
+    """Inicializa um processo do pool com o mesmo nível de log do servidor."""
+    logging.basicConfig(level=log_level)
+
+
+class BytesIterFile:
+    """Adapta um iterador de blocos de bytes à interface read(n) usada pelo ijson."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._pending = b''
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            # Sem tamanho: devolve todo o restante do fluxo, como um arquivo comum
+            rest = self._pending + b''.join(self._chunks)
+            self._pending = b''
+            return rest
+        chunk = self._pending or next(self._chunks, b'')
+        if size < len(chunk):
+            chunk, self._pending = chunk[:size], chunk[size:]
+        else:
+            self._pending = b''
+        return chunk
+
+
+def parse_json3_subtitles(sub_data: bytes | BytesIterFile) -> str:
+    """Converte formato JSON3 do YouTube em texto de forma mais robusta."""
+    try:
+        words = []
+        
+        # O JSON3 tem formato fixo (events[*].segs[*].utf8): o parser entrega só
+        # os textos, ignorando tempos, janelas e demais campos dos eventos
+        texts = ijson.items(sub_data, 'events.item.segs.item.utf8', use_float=True)
+        for u in texts:
+            if u:
+                # split() já descarta quebras de linha e espaços repetidos
+                words.extend(u.split())
+
+        # Uma única junção, já com os espaços normalizados
+        full_text = ' '.join(words)
+        
+        logger.info("Texto extraído tem %d caracteres", len(full_text))
+        if len(full_text) < 100:
+            logger.warning("Transcrição muito curta: %d caracteres", len(full_text))
+            
+        return full_text
+        
+    except ijson.JSONError as e:
+        logger.error("Erro de decodificação JSON: %s", e)
+        raise
@@ -1,18 +1,120 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import yt_dlp
+from yt_dlp.utils.networking import std_headers
+import httpx
+from uvicorn.config import LOG_LEVELS
+from cachetools import TTLCache
+from json3 import BytesIterFile, init_worker, parse_json3_subtitles
 import re
+import asyncio
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import logging
-import traceback
-import tempfile
+import multiprocessing
 import os
-import subprocess
-import json
+import threading
+from contextlib import asynccontextmanager
 
-logging.basicConfig(level=logging.DEBUG)
+# Aceita apenas os nomes que tanto o logging quanto o uvicorn entendem
+_requested_log_level = (os.getenv("LOG_LEVEL") or "INFO").lower()
+LOG_LEVEL = _requested_log_level if _requested_log_level in LOG_LEVELS else "info"
+
+logging.basicConfig(level=LOG_LEVELS[LOG_LEVEL])
 logger = logging.getLogger(__name__)
+if LOG_LEVEL != _requested_log_level:
+    logger.warning(
+        "LOG_LEVEL inválido: %r (use um de: %s); usando INFO",
+        _requested_log_level, ', '.join(LOG_LEVELS),
+    )
+
+
+_VIDEO_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+# Cobre watch?v=, watch?...&v=, youtu.be/ e embed/: todos terminam em "v=" ou "/"
+_URL_VIDEO_ID_RE = re.compile(r'(?:v=|/)([0-9A-Za-z_-]{11})')
+
+# Cliente compartilhado: mantém as conexões (HTTP/2, keep-alive) entre downloads
+_HTTP = httpx.Client(
+    http2=True,
+    follow_redirects=True,
+    timeout=10.0,
+    headers={'User-Agent': std_headers['User-Agent']},
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60.0),
+)
+
+# Caches em memória (1 hora) para não repetir o extract_info nem o download/parse
+_INFO_CACHE = TTLCache(maxsize=1024, ttl=3600)
+# Limitado pelo total de caracteres das transcrições, não pelo número de entradas
+_TRANSCRIPTION_CACHE = TTLCache(maxsize=16 * 1024 * 1024, ttl=3600, getsizeof=len)
+_CACHE_LOCK = threading.Lock()
+# Campos do extract_info usados pelos endpoints
+_CACHED_INFO_KEYS = ('title', 'duration', 'uploader', 'upload_date')
+# Idiomas cujas faixas de legenda são de fato baixadas
+_CAPTION_LANGS = ('pt', 'pt-BR', 'pt-PT', 'en')
+
+
+def _read_subtitle_processes() -> int:
+    """Lê SUBTITLE_PROCESSES; o padrão divide as CPUs entre os workers do uvicorn."""
+    value = os.getenv("SUBTITLE_PROCESSES")
+    if value:
+        if value.isdigit():
+            return int(value)
+        logger.warning("SUBTITLE_PROCESSES inválido: %r; usando o padrão", value)
+    web_concurrency = os.getenv("WEB_CONCURRENCY", "1")
+    workers = int(web_concurrency) if web_concurrency.isdigit() else 1
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+# Processos por worker do uvicorn; 0 desliga o pool (o parse roda no threadpool)
+SUBTITLE_PROCESSES = _read_subtitle_processes()
+
+
+def _new_subtitle_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Cria o pool de processos usado para converter as legendas JSON3."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=SUBTITLE_PROCESSES,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(LOG_LEVELS[LOG_LEVEL],),
+    )
+
+
+# Só o parse das legendas roda em processos separados: ele segura a GIL e travaria
+# os outros handlers, enquanto o download continua nas threads das requisições.
+# "spawn" evita herdar threads e conexões abertas; os processos só importam json3.
+# O pool é criado no lifespan, então importar main não cria processos nem filas.
+_POOL = None
+# Protege a troca do pool quando um processo morre (ex.: OOM kill)
+_POOL_LOCK = threading.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _POOL
+    if SUBTITLE_PROCESSES:
+        _POOL = _new_subtitle_pool()
+        # Sobe todos os processos agora, não na primeira requisição; os.getpid é
+        # builtin, então a tarefa não faz o processo importar nada além de json3
+        await asyncio.gather(*(
+            asyncio.wrap_future(_POOL.submit(os.getpid))
+            for _ in range(SUBTITLE_PROCESSES)
+        ))
+    yield
+    if _POOL is not None:
+        _POOL.shutdown(cancel_futures=True)
+        _POOL = None
 
-app = FastAPI(title="API de Transcrição de Vídeo do YouTube")
+
+app = FastAPI(
+    title="API de Transcrição de Vídeo do YouTube",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+# Transcrições são texto repetitivo e comprimem bem
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 
 class HealthCheckResponse(BaseModel):
@@ -30,26 +132,30 @@ class TranscriptionResponse(BaseModel):
 
 def extract_video_id(url: str) -> str:
     """Extrai o ID do vídeo da URL do YouTube."""
-    if re.match(r'^[0-9A-Za-z_-]{11}$', url):
+    if _VIDEO_ID_RE.match(url):
         return url
     
-    patterns = [
-        r"(?:v=|/)([0-9A-Za-z_-]{11})",
-        r"youtu.be/([0-9A-Za-z_-]{11})",
-        r"watch\?v=([0-9A-Za-z_-]{11})",
-        r"embed/([0-9A-Za-z_-]{11})",
-        r"watch\?.*&v=([0-9A-Za-z_-]{11})"
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+    match = _URL_VIDEO_ID_RE.search(url)
+    if match:
+        return match.group(1)
     
     raise ValueError("ID do vídeo não encontrado na URL.")
 
 
 def get_subtitles_with_ytdlp(video_url: str, language: str = "pt") -> str:
+    """Obtém legendas usando yt-dlp, reaproveitando transcrições recentes."""
+    cache_key = (video_url, language)
+    with _CACHE_LOCK:
+        transcription = _TRANSCRIPTION_CACHE.get(cache_key)
+    if transcription is None:
+        transcription = fetch_subtitles_with_ytdlp(video_url, language)
+        if len(transcription) <= _TRANSCRIPTION_CACHE.maxsize:
+            with _CACHE_LOCK:
+                _TRANSCRIPTION_CACHE[cache_key] = transcription
+    return transcription
+
+
+def fetch_subtitles_with_ytdlp(video_url: str, language: str = "pt") -> str:
     """Obtém legendas usando yt-dlp."""
     ydl_opts = {
         'writesubtitles': True,
@@ -62,109 +168,124 @@ def get_subtitles_with_ytdlp(video_url: str, language: str = "pt") -> str:
     }
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            
-            # Verifica legendas disponíveis
-            subtitles = info.get('subtitles', {})
-            automatic_captions = info.get('automatic_captions', {})
-            
-            # Prioridade: legendas manuais em português
-            for lang in ['pt', 'pt-BR', 'pt-PT']:
-                if lang in subtitles:
-                    logger.info(f"Encontradas legendas manuais em {lang}")
-                    for sub in subtitles[lang]:
-                        if sub.get('ext') == 'json3':
-                            logger.info(f"Baixando legendas de: {sub['url']}")
-                            sub_data = ydl.urlopen(sub['url']).read().decode('utf-8')
-                            logger.info(f"Dados das legendas baixados: {len(sub_data)} bytes")
-                            return parse_json3_subtitles(sub_data)
-            
-            # Segunda opção: legendas automáticas em português
-            for lang in ['pt', 'pt-BR', 'pt-PT']:
-                if lang in automatic_captions:
-                    logger.info(f"Encontradas legendas automáticas em {lang}")
-                    for sub in automatic_captions[lang]:
-                        if sub.get('ext') == 'json3':
-                            logger.info(f"Baixando legendas automáticas de: {sub['url']}")
-                            sub_data = ydl.urlopen(sub['url']).read().decode('utf-8')
-                            logger.info(f"Dados das legendas automáticas baixados: {len(sub_data)} bytes")
-                            return parse_json3_subtitles(sub_data)
-            
-            # Terceira opção: legendas em inglês para traduzir
-            if 'en' in subtitles or 'en' in automatic_captions:
-                subs_dict = subtitles.get('en', automatic_captions.get('en', []))
-                for sub in subs_dict:
-                    if sub.get('ext') == 'json3':
-                        sub_data = ydl.urlopen(sub['url']).read().decode('utf-8')
-                        transcription = parse_json3_subtitles(sub_data)
-                        return f"[Transcrição em inglês - tradução automática não disponível]\n\n{transcription}"
+        info = extract_video_info(video_url, ydl_opts)
+        
+        # Verifica legendas disponíveis
+        subtitles = info.get('subtitles', {})
+        automatic_captions = info.get('automatic_captions', {})
+        
+        # Prioridade: legendas manuais em português
+        for lang in ['pt', 'pt-BR', 'pt-PT']:
+            if lang in subtitles:
+                logger.info("Encontradas legendas manuais em %s", lang)
+                sub = find_json3_track(subtitles[lang])
+                if sub:
+                    logger.debug("Baixando legendas de: %s", sub['url'])
+                    return download_and_parse_json3_subtitles(sub['url'])
+        
+        # Segunda opção: legendas automáticas em português
+        for lang in ['pt', 'pt-BR', 'pt-PT']:
+            if lang in automatic_captions:
+                logger.info("Encontradas legendas automáticas em %s", lang)
+                sub = find_json3_track(automatic_captions[lang])
+                if sub:
+                    logger.debug("Baixando legendas automáticas de: %s", sub['url'])
+                    return download_and_parse_json3_subtitles(sub['url'])
+        
+        # Terceira opção: legendas em inglês para traduzir
+        if 'en' in subtitles or 'en' in automatic_captions:
+            sub = find_json3_track(subtitles.get('en', automatic_captions.get('en', [])))
+            if sub:
+                transcription = download_and_parse_json3_subtitles(sub['url'])
+                return f"[Transcrição em inglês - tradução automática não disponível]\n\n{transcription}"
+        
+        # Lista todas as legendas disponíveis para debug
+        all_langs = {*info['subtitle_langs'], *info['automatic_caption_langs']}
+        if all_langs:
+            raise ValueError(f"Legendas disponíveis apenas em: {', '.join(all_langs)}")
+        else:
+            raise ValueError("Nenhuma legenda disponível para este vídeo")
             
-            # Lista todas as legendas disponíveis para debug
-            all_langs = list(subtitles.keys()) + list(automatic_captions.keys())
-            if all_langs:
-                raise ValueError(f"Legendas disponíveis apenas em: {', '.join(set(all_langs))}")
-            else:
-                raise ValueError("Nenhuma legenda disponível para este vídeo")
-                
-    except Exception as e:
-        logger.error(f"Erro ao obter legendas com yt-dlp: {e}")
+    except (yt_dlp.utils.DownloadError, httpx.HTTPError) as e:
+        logger.error("Erro ao obter legendas com yt-dlp: %s", e)
         raise
 
 
-def parse_json3_subtitles(json_data: str) -> str:
-    """Converte formato JSON3 do YouTube em texto de forma mais robusta."""
+def extract_video_info(video_url: str, ydl_opts: dict) -> dict:
+    """Executa o extract_info do yt-dlp, reaproveitando resultados recentes."""
+    with _CACHE_LOCK:
+        info = _INFO_CACHE.get(video_url)
+    if info is None:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            full_info = ydl.extract_info(video_url, download=False)
+        subtitles = full_info.get('subtitles') or {}
+        automatic_captions = full_info.get('automatic_captions') or {}
+        # Guarda só o que os endpoints leem: as faixas JSON3 dos idiomas usados e os
+        # nomes dos idiomas, em vez de todas as traduções automáticas e formatos
+        info = {key: full_info[key] for key in _CACHED_INFO_KEYS if key in full_info}
+        info['subtitles'] = _json3_tracks(subtitles)
+        info['automatic_captions'] = _json3_tracks(automatic_captions)
+        info['subtitle_langs'] = list(subtitles)
+        info['automatic_caption_langs'] = list(automatic_captions)
+        with _CACHE_LOCK:
+            _INFO_CACHE[video_url] = info
+    return info
+
+
+def _json3_tracks(tracks_by_lang: dict) -> dict:
+    """Reduz as legendas de cada idioma de _CAPTION_LANGS à primeira faixa JSON3."""
+    slim = {}
+    for lang in _CAPTION_LANGS:
+        if lang in tracks_by_lang:
+            sub = find_json3_track(tracks_by_lang[lang])
+            slim[lang] = [{'ext': 'json3', 'url': sub['url']}] if sub else []
+    return slim
+
+
+def find_json3_track(tracks: list) -> dict | None:
+    """Retorna a primeira faixa de legendas em formato JSON3, se houver."""
+    return next((sub for sub in tracks if sub.get('ext') == 'json3'), None)
+
+
+def download_subtitles(url: str) -> bytes:
+    """Baixa o arquivo de legendas inteiro usando o cliente HTTP compartilhado."""
+    response = _HTTP.get(url)
+    response.raise_for_status()
+    logger.info("Dados das legendas baixados: %d bytes", len(response.content))
+    return response.content
+
+
+def download_json3_subtitles(url: str) -> str:
+    """Baixa as legendas JSON3 e as converte em texto à medida que os bytes chegam."""
+    with _HTTP.stream('GET', url) as response:
+        response.raise_for_status()
+        transcription = parse_json3_subtitles(BytesIterFile(response.iter_bytes(64 * 1024)))
+        logger.info("Dados das legendas baixados: %d bytes", response.num_bytes_downloaded)
+    return transcription
+
+
+def download_and_parse_json3_subtitles(url: str) -> str:
+    """Baixa as legendas na thread atual e converte o JSON3 num processo do pool."""
+    pool = _POOL
+    if pool is None:
+        # Sem pool: converte enquanto os bytes chegam, na própria thread
+        return download_json3_subtitles(url)
+    sub_bytes = download_subtitles(url)
     try:
-        data = json.loads(json_data)
-        text_parts = []
-        
-        for event in data.get('events', []):
-            if not isinstance(event, dict):
-                continue
+        return pool.submit(parse_json3_subtitles, sub_bytes).result()
+    except BrokenProcessPool:
+        logger.warning("Pool de processos inutilizável; recriando e tentando de novo")
+        return _replace_broken_pool(pool).submit(parse_json3_subtitles, sub_bytes).result()
 
-            # Coleta todo o texto do evento, incluindo aninhados
-            texts = []
-            
-            def extract_text_from_event(e):
-                if isinstance(e, dict):
-                    if 'segs' in e:
-                        for seg in e['segs']:
-                            if isinstance(seg, dict) and 'utf8' in seg:
-                                texts.append(seg['utf8'])
-                    # Extrai texto de outras chaves comuns
-                    for key in ['aAppend', 'wWinId']:
-                         if key in e and isinstance(e[key], str):
-                                texts.append(e[key])
-                elif isinstance(e, list):
-                    for item in e:
-                        extract_text_from_event(item)
-
-            extract_text_from_event(event)
-            
-            # Processa e limpa o texto coletado
-            for text in texts:
-                cleaned_text = text.replace('\n', ' ').strip()
-                if cleaned_text:
-                    text_parts.append(cleaned_text)
-
-        # Junta todo o texto e normaliza os espaços
-        full_text = ' '.join(text_parts)
-        full_text = re.sub(r'\s+', ' ', full_text).strip()
-        
-        logger.info(f"Texto extraído tem {len(full_text)} caracteres")
-        if len(full_text) < 100:
-            logger.warning(f"Transcrição muito curta. Dados JSON (primeiros 300 chars): {json_data[:300]}")
-            
-        return full_text
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"Erro de decodificação JSON: {e}")
-        logger.error(f"Dados recebidos (primeiros 300 chars): {json_data[:300]}")
-        raise
-    except Exception as e:
-        logger.error(f"Erro inesperado ao processar JSON3: {e}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        raise
+
+def _replace_broken_pool(broken: concurrent.futures.ProcessPoolExecutor) -> concurrent.futures.ProcessPoolExecutor:
+    """Troca o pool quebrado por um novo, uma única vez mesmo com chamadas concorrentes."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is broken:
+            _POOL = _new_subtitle_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+        return _POOL
 
 
 @app.get("/", response_model=HealthCheckResponse)
@@ -177,10 +298,13 @@ async def transcribe_video(request: TranscriptionRequest):
     try:
         video_id = extract_video_id(request.url)
         video_url = f"https://www.youtube.com/watch?v={video_id}"
-        logger.info(f"Extraindo transcrição para vídeo ID: {video_id}")
+        logger.info("Extraindo transcrição para vídeo ID: %s", video_id)
         
         try:
-            transcription = get_subtitles_with_ytdlp(video_url, request.language)
+            # yt-dlp faz I/O bloqueante; roda fora do event loop
+            transcription = await run_in_threadpool(
+                get_subtitles_with_ytdlp, video_url, request.language
+            )
             
             if transcription and transcription.strip():
                 return TranscriptionResponse(transcription=transcription.strip())
@@ -193,8 +317,7 @@ async def transcribe_video(request: TranscriptionRequest):
         except ValueError as e:
             raise HTTPException(status_code=404, detail=str(e))
         except Exception as e:
-            logger.error(f"Erro ao processar transcrição: {e}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            logger.exception("Erro ao processar transcrição: %s", e)
             raise HTTPException(
                 status_code=500,
                 detail=f"Erro ao processar transcrição: {str(e)}"
@@ -205,13 +328,12 @@ async def transcribe_video(request: TranscriptionRequest):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Erro inesperado: {e}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Erro inesperado: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro inesperado: {str(e)}")
 
 
 @app.get("/test/{video_id}")
-async def test_video(video_id: str):
+def test_video(video_id: str):
     """Endpoint de teste para verificar disponibilidade de transcrições"""
     video_url = f"https://www.youtube.com/watch?v={video_id}"
     results = {
@@ -229,18 +351,17 @@ async def test_video(video_id: str):
             'extract_flat': False,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            
-            results["available_subtitles"] = list(info.get('subtitles', {}).keys())
-            results["automatic_captions"] = list(info.get('automatic_captions', {}).keys())
-            results["video_info"] = {
-                "title": info.get('title'),
-                "duration": info.get('duration'),
-                "uploader": info.get('uploader'),
-                "upload_date": info.get('upload_date')
-            }
-            
+        info = extract_video_info(video_url, ydl_opts)
+        
+        results["available_subtitles"] = info['subtitle_langs']
+        results["automatic_captions"] = info['automatic_caption_langs']
+        results["video_info"] = {
+            "title": info.get('title'),
+            "duration": info.get('duration'),
+            "uploader": info.get('uploader'),
+            "upload_date": info.get('upload_date')
+        }
+        
     except Exception as e:
         results["errors"].append({"error": str(e), "type": type(e).__name__})
     
@@ -249,4 +370,4 @@ async def test_video(video_id: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="debug")
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level=LOG_LEVEL, loop="uvloop", http="httptools")